@@ -1,19 +1,24 @@
 #!/usr/bin/env python3
 """
 Encode Bot using Pyrogram (async) suitable for Render deployment.
-- Receives a video via /encode flow, encodes with ffmpeg (libx265), and returns the file.
+- Receives a video via /encode flow, encodes with ffmpeg (HEVC; hardware encoder if available, else libx265;
+  or AV1 via SVT-AV1 with CODEC=av1), and returns the file.
 Notes:
 - Ensure ffmpeg is installed on the host (Render does not include ffmpeg by default).
 - Telegram bot upload limit applies (~50MB for bot accounts). For larger files consider using a user session (not covered here) or external upload.
 """
 import os
 import asyncio
+import glob
 import shlex
+import sqlite3
+import tempfile
+import time
 import uuid
 import logging
-import subprocess
 from pathlib import Path
 
+from cachetools import TTLCache
 from pyrogram import Client, filters
 from pyrogram.types import Message
 import config
@@ -23,6 +28,53 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 TMP_DIR = config.TMP_DIR
+CRF = str(config.CRF)
+PRESET = str(config.PRESET)
+TUNE = str(config.TUNE)
+BOT_NAME = config.BOT_NAME
+ENCODER = config.ENCODER
+CODEC = config.CODEC
+AV1_PRESET = str(config.AV1_PRESET)
+X265_POOL_THREADS = config.X265_POOL_THREADS
+VAAPI_DEVICE = config.VAAPI_DEVICE
+CODEC_LABEL = "AV1" if CODEC == "av1" else "HEVC (H.265)"
+# ffprobe codec names that already match the target codec and can be remuxed as-is
+COPY_CODECS = ("av1",) if CODEC == "av1" else ("hevc", "h265")
+FFMPEG_TIMEOUT = 3600  # seconds
+# Fragmented MP4: moov goes up front and ffmpeg never rewrites the file at the end,
+# so the output is ready to upload (or stream) the moment ffmpeg exits.
+MP4_MOVFLAGS = "+frag_keyframe+empty_moov"
+PROGRESS_INTERVAL = 5  # seconds between download progress edits
+STATUS_MIN_INTERVAL = 2  # minimum seconds between non-forced status message edits
+PREVIEW_HEIGHT = 720
+STREAM_CHUNK_SIZE = 1 << 16
+# Encoded output is spooled in RAM up to this size, then spills to a temp file in TMP_DIR
+SPOOL_MAX_SIZE = 64 << 20
+# Encodes estimated to be bigger than this are done as a series of parts that each fit under the
+# ~50MB bot upload limit. Headroom below 49.5MB because the segment muxer can only cut on a keyframe.
+SEGMENT_BUDGET = 45 << 20
+# The output size estimate encodes this many seconds from the middle of the input and extrapolates,
+# padded by SAMPLE_MARGIN because bitrate varies across a video
+SAMPLE_SECONDS = 10
+SAMPLE_MARGIN = 1.2
+SEGMENT_MIN_TIME = 10  # seconds
+SEGMENT_POLL_INTERVAL = 1  # seconds between checks for a finished part
+TMP_GC_INTERVAL = 60  # seconds between TMP_DIR sweeps
+# Files untouched for this long are leftovers from killed handlers. Inputs are touched when their job
+# leaves the ENCODE_SEMAPHORE queue, so this only has to exceed FFMPEG_TIMEOUT plus a thumbnail/upload.
+TMP_MAX_AGE = 3 * 3600
+# Caps concurrent ffmpeg processes; extra jobs queue here instead of thrashing the CPU
+ENCODE_SEMAPHORE = asyncio.Semaphore(config.MAX_ENCODES)
+
+# Fixed parts of the ffmpeg argv, built once; requests only concatenate lists
+FFMPEG_PREFIX = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"]
+# Map exactly the streams probe_codec/probe_audio looked at; ffmpeg's default picks the audio track with
+# the most channels, which in multi-audio MKVs may be a DTS/TrueHD track that can't be copied into MP4
+FFMPEG_MAP_ARGS = ["-map", "0:v:0", "-map", "0:a:0?"]
+FFMPEG_PIPE_ARGS = ["-movflags", MP4_MOVFLAGS, "-f", "mp4", "pipe:1"]
+# Audio that isn't AAC, or is AAC above this bitrate, is re-encoded to compact stereo AAC
+AUDIO_MAX_BITRATE = 128000
+AUDIO_REENCODE_ARGS = ["-c:a", "aac", "-b:a", "96k", "-ac", "2"]
 
 # Build Pyrogram Client. If API_ID/API_HASH provided, use them, else use bot-only
 client_kwargs = {}
@@ -34,145 +86,660 @@ else:
     # Bot-only mode
     client = Client("encode-bot", bot_token=config.BOT_TOKEN)
 
+def _open_cache(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS encoded ("
+        "source_id TEXT NOT NULL, settings TEXT NOT NULL, part INTEGER NOT NULL, file_id TEXT NOT NULL, "
+        "PRIMARY KEY (source_id, settings, part))"
+    )
+    conn.commit()
+    return conn
+
+encode_cache = _open_cache(config.CACHE_DB)
+
+def cache_lookup(source_id: str, settings: str) -> list:
+    """
+    Return the file_ids (in part order) of a previous encode of `source_id` with `settings`, or [].
+    """
+    rows = encode_cache.execute(
+        "SELECT file_id FROM encoded WHERE source_id = ? AND settings = ? ORDER BY part",
+        (source_id, settings),
+    ).fetchall()
+    return [row[0] for row in rows]
+
+def cache_store(source_id: str, settings: str, file_ids: list) -> None:
+    with encode_cache:
+        encode_cache.execute("DELETE FROM encoded WHERE source_id = ? AND settings = ?", (source_id, settings))
+        encode_cache.executemany(
+            "INSERT INTO encoded (source_id, settings, part, file_id) VALUES (?, ?, ?, ?)",
+            [(source_id, settings, part, file_id) for part, file_id in enumerate(file_ids)],
+        )
+
+def cache_delete(source_id: str, settings: str) -> None:
+    with encode_cache:
+        encode_cache.execute("DELETE FROM encoded WHERE source_id = ? AND settings = ?", (source_id, settings))
+
+def sent_file_id(sent: Message) -> str:
+    """
+    Return the file_id of an uploaded encode, or "" if the reply carries no document/video.
+    """
+    media = sent.document or sent.video if sent else None
+    return media.file_id if media else ""
+
 def safe_filename(original_name: str) -> str:
     base = os.path.basename(original_name)
     return f"{uuid.uuid4().hex}_{base}"
 
+_VIDEO_EXTS = (".mp4", ".mkv", ".mov", ".avi", ".webm", ".ts", ".m4v")
+
 def fname_looks_like_video(name: str) -> bool:
-    name = (name or "").lower()
-    return any(name.endswith(ext) for ext in (".mp4", ".mkv", ".mov", ".avi", ".webm", ".ts", ".m4v"))
+    return (name or "").lower().endswith(_VIDEO_EXTS)
+
+async def _ffprobe(path: str, args: list, fmt: str = "csv=p=0") -> str:
+    """
+    Run ffprobe with `args` on `path` and return its stripped stdout (in output format `fmt`), or "" if ffprobe fails.
+    """
+    cmd = ["ffprobe", "-v", "error"] + args + ["-of", fmt, path]
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        stdout, _ = await proc.communicate()
+    except Exception:
+        logger.exception("ffprobe failed for %s", path)
+        return ""
+    if proc.returncode != 0:
+        return ""
+    return stdout.decode(errors="ignore").strip()
+
+async def probe_codec(path: str) -> str:
+    """
+    Return the codec name of the first video stream (e.g. "hevc", "h264"), or "" if ffprobe fails.
+    """
+    return (await _ffprobe(path, ["-select_streams", "v:0", "-show_entries", "stream=codec_name"])).lower()
+
+async def probe_audio(path: str) -> (str, int):
+    """
+    Return (codec_name, bit_rate) of the first audio stream. codec_name is "" if there is no audio.
+    MKV never reports a stream bit_rate, so fall back to the BPS / BPS-eng tags mkvmerge writes;
+    bit_rate is 0 if neither is available.
+    """
+    out = await _ffprobe(
+        path,
+        ["-select_streams", "a:0", "-show_entries", "stream=codec_name,bit_rate:stream_tags=BPS,BPS-eng"],
+        fmt="default=noprint_wrappers=1",
+    )
+    fields = dict(line.partition("=")[::2] for line in out.splitlines())
+    bit_rate = next(
+        (int(value) for value in (fields.get(key, "") for key in ("bit_rate", "TAG:BPS", "TAG:BPS-eng")) if value.isdigit()),
+        0,
+    )
+    return fields.get("codec_name", "").lower(), bit_rate
+
+async def probe_duration(path: str) -> float:
+    """
+    Return the container duration in seconds, or 0.0 if it can't be determined.
+    """
+    try:
+        return float(await _ffprobe(path, ["-show_entries", "format=duration"]))
+    except ValueError:
+        return 0.0
+
+def video_codec_args(encoder: str, crf: str, preset: str, tune: str = "", height: int = 0) -> list:
+    """
+    Build the video encoder arguments. CRF is translated to each hardware encoder's own quality knob;
+    preset/tune only apply to libx265 (libsvtav1 uses AV1_PRESET). A non-zero `height` downscales (keeping aspect ratio).
+    """
+    crf = str(crf)
+    vf = [f"scale=-2:{height}"] if height else []
+    if encoder == "hevc_vaapi":
+        vf += ["format=nv12", "hwupload"]
+    args = ["-vf", ",".join(vf)] if vf else []
+    if encoder == "hevc_nvenc":
+        return args + ["-c:v", encoder, "-rc", "vbr", "-cq", crf, "-b:v", "0"]
+    if encoder == "hevc_qsv":
+        return args + ["-c:v", encoder, "-global_quality", crf]
+    if encoder == "hevc_vaapi":
+        return args + ["-c:v", encoder, "-qp", crf]
+    if encoder == "hevc_videotoolbox":
+        # -q:v is 1-100 (higher is better); map CRF 0-51 onto it
+        quality = max(1, min(100, round(100 - 2 * float(crf))))
+        return args + ["-c:v", encoder, "-q:v", str(quality), "-tag:v", "hvc1"]
+    if encoder == "hevc_v4l2m2m":
+        # No constant-quality mode; uses the driver's default rate control
+        return args + ["-c:v", encoder]
+    if encoder == "libsvtav1":
+        return args + [
+            "-c:v", encoder, "-preset", AV1_PRESET, "-crf", crf,
+            "-svtav1-params", "tune=0:fast-decode=1"
+        ]
+    args += ["-c:v", "libx265", "-crf", crf, "-preset", str(preset)]
+    if tune:
+        args += ["-tune", str(tune)]
+    # Size x265's thread pool so MAX_ENCODES concurrent jobs together use every core without oversubscribing
+    args += ["-x265-params", f"crf={crf}:pools={X265_POOL_THREADS}"]
+    return args
+
+def touch(path: str) -> None:
+    """
+    Refresh `path`'s mtime so gc_tmp doesn't treat a file that sat in the encode queue as stale.
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+class NamedSpool(tempfile.SpooledTemporaryFile):
+    """
+    SpooledTemporaryFile whose .name is the upload filename. Pyrogram's save_file takes the upload
+    name from fp.name, which on a plain spool is None in RAM and an int fd once rolled over to disk.
+    """
+    def __init__(self, name: str, max_size: int = SPOOL_MAX_SIZE, dir: str = TMP_DIR):
+        super().__init__(max_size=max_size, dir=dir)
+        self._upload_name = name
+
+    @property
+    def name(self):
+        return self._upload_name
+
+async def _copy_stream(reader: asyncio.StreamReader, out_file) -> None:
+    while True:
+        chunk = await reader.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            return
+        out_file.write(chunk)
+
+async def build_ffmpeg_cmd(in_path: str, crf: str, preset: str, tune: str, encoder: str, height: int, seek: float = 0) -> (list, bool):
+    """
+    Build the ffmpeg argv up to (not including) the output options. A non-zero `seek` starts reading
+    the input at that many seconds (keyframe seek, -ss before -i).
+    Returns (cmd, copied) where `copied` is True if the video is remuxed rather than re-encoded.
+    """
+    codec = await probe_codec(in_path)
+    audio_codec, audio_bitrate = await probe_audio(in_path)
+    # An unknown bitrate can't be shown to be small, so it's re-encoded too
+    if audio_codec and (audio_codec != "aac" or not audio_bitrate or audio_bitrate > AUDIO_MAX_BITRATE):
+        audio_args = AUDIO_REENCODE_ARGS
+    else:
+        audio_args = ["-c:a", "copy"]
+    # Subtitles are dropped: most (ASS, SRT, PGS) can't be stored in MP4 and would fail the mux
+    audio_args = audio_args + ["-sn"]
+    if codec in COPY_CODECS and not height:
+        # Already in the target codec: remux instead of re-encoding
+        return FFMPEG_PREFIX + ["-i", in_path] + FFMPEG_MAP_ARGS + ["-c:v", "copy"] + audio_args, True
+    cmd = FFMPEG_PREFIX[:]
+    if encoder == "hevc_vaapi":
+        cmd += ["-vaapi_device", VAAPI_DEVICE]
+    if seek:
+        cmd += ["-ss", f"{seek:.3f}"]
+    cmd += ["-i", in_path] + FFMPEG_MAP_ARGS
+    cmd += video_codec_args(encoder, crf, preset, tune, height)
+    cmd += audio_args
+    return cmd, False
+
+async def run_ffmpeg(in_path: str, out_file, crf: str, preset: str, tune: str = "", encoder: str = ENCODER, height: int = 0, timeout: int = FFMPEG_TIMEOUT) -> (int, str):
+    """
+    Run ffmpeg as an asyncio subprocess so it doesn't block the event loop or hold an executor thread.
+    The MP4 is written to ffmpeg's stdout and streamed into `out_file` (a writable binary file object),
+    so the encoded file never takes a round trip through a temporary path on disk.
+    At most config.MAX_ENCODES run at once; the rest wait their turn.
+    Pass `height` to downscale (e.g. 720 for previews).
+    Returns (returncode, stderr_output). Raises asyncio.TimeoutError if ffmpeg runs longer than `timeout` seconds.
+    """
+    cmd, _ = await build_ffmpeg_cmd(in_path, crf, preset, tune, encoder, height)
+    cmd += FFMPEG_PIPE_ARGS
+    logger.info("Running ffmpeg: %s", " ".join(shlex.quote(x) for x in cmd))
+    async with ENCODE_SEMAPHORE:
+        touch(in_path)
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            _, stderr, _ = await asyncio.wait_for(
+                asyncio.gather(_copy_stream(proc.stdout, out_file), proc.stderr.read(), proc.wait()),
+                timeout=timeout,
+            )
+        finally:
+            if proc.returncode is None:
+                # Timed out, the spool write failed (e.g. disk full) or we were cancelled:
+                # don't leave a runaway ffmpeg blocked on a pipe nobody reads
+                proc.kill()
+                await proc.wait()
+    return proc.returncode, stderr.decode(errors="ignore")
+
+async def estimate_output_size(in_path: str, duration: float, crf: str, preset: str, tune: str = "", encoder: str = ENCODER, timeout: int = FFMPEG_TIMEOUT) -> int:
+    """
+    Estimate the encoded size in bytes by encoding a SAMPLE_SECONDS clip from the middle of the input
+    with the real settings and extrapolating to `duration`. Remuxes keep the input size.
+    Falls back to the input size (an upper bound in practice) if the sample can't be encoded
+    or takes longer than `timeout` seconds.
+    """
+    in_size = os.path.getsize(in_path)
+    sample = min(SAMPLE_SECONDS, duration)
+    start = max(0.0, duration / 2 - sample / 2)
+    cmd, copied = await build_ffmpeg_cmd(in_path, crf, preset, tune, encoder, 0, seek=start)
+    if copied:
+        return in_size
+    cmd += ["-t", f"{sample:.3f}"] + FFMPEG_PIPE_ARGS
+    async def measure(proc) -> int:
+        size = 0
+        while True:
+            chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+        await proc.wait()
+        return size
+
+    async with ENCODE_SEMAPHORE:
+        touch(in_path)
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        try:
+            sample_size = await asyncio.wait_for(measure(proc), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Output size sample timed out for %s", in_path)
+            return in_size
+        finally:
+            if proc.returncode is None:
+                # Timed out or cancelled: don't leave a runaway ffmpeg holding the semaphore slot
+                proc.kill()
+                await proc.wait()
+    if proc.returncode != 0 or not sample_size:
+        return in_size
+    return int(sample_size * duration / sample * SAMPLE_MARGIN)
 
-async def run_ffmpeg(in_path: str, out_path: str, crf: str, preset: str) -> (int, str):
+async def run_ffmpeg_segmented(in_path: str, out_pattern: str, segment_time: float, on_segment, crf: str, preset: str, tune: str = "", encoder: str = ENCODER, timeout: int = FFMPEG_TIMEOUT) -> (int, str):
     """
-    Run ffmpeg in a thread to avoid blocking the event loop.
-    Returns (returncode, stderr_output)
+    Encode into parts of roughly `segment_time` seconds using ffmpeg's segment muxer.
+    `out_pattern` is a printf-style path such as ".../abc_part%03d.mp4". Each part is passed to
+    `await on_segment(path, index)` as soon as ffmpeg moves on to the next one, so uploads overlap
+    with encoding of the remaining parts. ENCODE_SEMAPHORE is only held while ffmpeg runs.
+    Returns (returncode, stderr_output) like run_ffmpeg.
     """
-    cmd = [
-        "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
-        "-i", in_path,
-        "-c:v", "libx265", "-crf", str(crf), "-preset", str(preset),
-        "-c:a", "copy", "-c:s", "copy",
-        out_path
+    cmd, copied = await build_ffmpeg_cmd(in_path, crf, preset, tune, encoder, 0)
+    if not copied:
+        # Put a keyframe at every boundary so parts are cut where intended
+        cmd += ["-force_key_frames", f"expr:gte(t,n_forced*{segment_time:.3f})"]
+    cmd += [
+        "-f", "segment", "-segment_time", f"{segment_time:.3f}", "-reset_timestamps", "1",
+        "-segment_format", "mp4", "-segment_format_options", f"movflags={MP4_MOVFLAGS}",
+        out_pattern
     ]
     logger.info("Running ffmpeg: %s", " ".join(shlex.quote(x) for x in cmd))
-    # Run in executor to avoid blocking
-    proc = await asyncio.get_event_loop().run_in_executor(None, lambda: subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE))
-    stderr = proc.stderr.decode(errors="ignore")
-    return proc.returncode, stderr
+
+    async def deliver_segments(proc_done: asyncio.Future) -> None:
+        index = 0
+        while True:
+            current, following = out_pattern % index, out_pattern % (index + 1)
+            finished = proc_done.done()
+            # A part is complete once ffmpeg has opened the next one, or exited successfully
+            if os.path.exists(following) or (finished and proc_done.result()[1] == 0 and os.path.exists(current)):
+                await on_segment(current, index)
+                index += 1
+            elif finished:
+                return
+            else:
+                await asyncio.sleep(SEGMENT_POLL_INTERVAL)
+
+    async with ENCODE_SEMAPHORE:
+        touch(in_path)
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        proc_done = asyncio.ensure_future(asyncio.gather(proc.stderr.read(), proc.wait()))
+        delivery = asyncio.ensure_future(deliver_segments(proc_done))
+        try:
+            # Wait for ffmpeg to exit, or for a part upload to fail, whichever comes first
+            await asyncio.wait({proc_done, delivery}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            delivery.cancel()
+            raise
+        finally:
+            timed_out = not proc_done.done() and not delivery.done()
+            if not proc_done.done():
+                # Timed out, a part failed to deliver, or we were cancelled: don't leave a runaway ffmpeg behind
+                proc.kill()
+            stderr, _ = await proc_done
+    if timed_out:
+        delivery.cancel()
+        raise asyncio.TimeoutError
+    # ffmpeg has exited; the remaining parts upload outside the semaphore so the next job can start encoding
+    await delivery
+    return proc.returncode, stderr.decode(errors="ignore")
+
+async def make_thumbnail(in_path: str, thumb_path: str) -> bool:
+    """
+    Grab a JPEG thumbnail fitting in 320x320 (Telegram's limit for both sides). -ss goes before -i so ffmpeg seeks to the nearest keyframe
+    instead of decoding everything up to that point. Returns True if the thumbnail was written.
+    """
+    for seek in ("5", "0"):  # fall back to the first frame for clips shorter than 5s
+        cmd = FFMPEG_PREFIX + [
+            "-ss", seek, "-i", in_path,
+            "-frames:v", "1", "-vf", "scale=320:320:force_original_aspect_ratio=decrease",
+            thumb_path
+        ]
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        await proc.wait()
+        if proc.returncode == 0 and os.path.exists(thumb_path) and os.path.getsize(thumb_path) > 0:
+            return True
+    return False
+
+class DebouncedMsg:
+    """
+    Wraps a status message so that progress edits are sent at most once every `min_interval` seconds.
+    Telegram rate-limits edits, and a FloodWait would otherwise stall the handler for seconds.
+    Skipped edits are simply dropped; pass force=True for messages the user must see (new phases, results, errors).
+    """
+    def __init__(self, msg: Message, min_interval: float = STATUS_MIN_INTERVAL):
+        self.msg = msg
+        self.min_interval = min_interval
+        self.last = time.monotonic()  # the message was just sent
+        self.text = msg.text
+
+    async def set(self, text: str, force: bool = False):
+        now = time.monotonic()
+        if text == self.text or (not force and now - self.last < self.min_interval):
+            return
+        if force:
+            await self.msg.edit_text(text)
+        else:
+            try:
+                await self.msg.edit_text(text)
+            except Exception:
+                # Progress is cosmetic; never let it break the job
+                logger.debug("Status edit failed", exc_info=True)
+                return
+        self.last = now
+        self.text = text
+
+async def download_progress(current: int, total: int, status: DebouncedMsg):
+    """
+    Pyrogram progress callback: show download percentage, at most once every PROGRESS_INTERVAL seconds.
+    """
+    if not total or time.monotonic() - status.last < PROGRESS_INTERVAL:
+        return
+    await status.set(f"⬇️ Downloading your file... {current * 100 / total:.0f}% ({current / (1024*1024):.1f}/{total / (1024*1024):.1f} MB)")
+
+async def gc_tmp():
+    """
+    Background task: periodically delete stale files from TMP_DIR that per-request cleanup never reached.
+    """
+    while True:
+        await asyncio.sleep(TMP_GC_INTERVAL)
+        now = time.time()
+        try:
+            with os.scandir(TMP_DIR) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file(follow_symlinks=False) and now - entry.stat().st_mtime > TMP_MAX_AGE:
+                            os.remove(entry.path)
+                            logger.info("Removed stale temp file %s", entry.name)
+                    except FileNotFoundError:
+                        pass
+        except Exception:
+            logger.exception("TMP_DIR cleanup failed")
+
+async def encode_in_parts(message: Message, status: DebouncedMsg, in_path: str, out_name: str, thumb_path: str, segment_time: float) -> list:
+    """
+    Encode `in_path` as a series of parts that each fit the bot upload limit, uploading every part
+    as soon as it is finished while ffmpeg keeps encoding the next one. Reports errors via `status`.
+    Returns the file_ids of the sent parts if every part was sent (and all ids are known), else [].
+    """
+    file_ids = []
+    base = os.path.splitext(out_name)[0]
+    out_pattern = os.path.join(TMP_DIR, f"{uuid.uuid4().hex}_part%03d.mp4")
+    thumb = thumb_path if await make_thumbnail(in_path, thumb_path) else None
+
+    async def send_part(path: str, index: int) -> None:
+        try:
+            await status.set(f"⚙️ Uploading part {index + 1} (encoding continues)...")
+            sent = await message.reply_document(path, file_name=f"{base}_part{index + 1:03d}.mp4", thumb=thumb, caption=f"✅ Encoded video, part {index + 1}.", force_document=True)
+            file_ids.append(sent_file_id(sent))
+        finally:
+            os.remove(path)
+
+    await status.set(f"🔹 Encoding started in ~{segment_time:.0f}s parts so each fits Telegram's 50MB limit...", force=True)
+    try:
+        retcode, stderr = await run_ffmpeg_segmented(in_path, out_pattern, segment_time, send_part, CRF, PRESET, TUNE)
+        if retcode != 0:
+            logger.error("FFmpeg error: %s", stderr[:2000])
+            await status.set("❌ Encoding failed. FFmpeg returned an error.", force=True)
+            await message.reply_text(f"FFmpeg error (short):\n{stderr[:1000] or 'No details'}")
+        else:
+            await status.set("✅ Done! All parts sent. Cleaning up...", force=True)
+            return file_ids if all(file_ids) else []
+    except asyncio.TimeoutError:
+        await status.set("❌ Encoding timed out.", force=True)
+    except Exception as e:
+        logger.exception("Segmented encode/upload failed")
+        await status.set(f"❌ Failed while encoding/uploading parts: {e}", force=True)
+    finally:
+        for p in glob.glob(out_pattern.replace("%03d", "*")):
+            try:
+                os.remove(p)
+            except Exception:
+                logger.exception("Cleanup error for %s", p)
+    return []
 
 @client.on_message(filters.command("start") & filters.private)
 async def start_handler(client: Client, message: Message):
-    welcome = f"👋 Hi! {config.BOT_NAME}\nI can encode videos to a smaller size using HEVC (H.265).\n\nUse /encode and then send the video file (mp4 / mkv)."
+    welcome = f"👋 Hi! {BOT_NAME}\nI can encode videos to a smaller size using {CODEC_LABEL}.\n\nUse /encode and then send the video file (mp4 / mkv)."
     await message.reply_text(welcome)
 
 @client.on_message(filters.command("help") & filters.private)
 async def help_handler(client: Client, message: Message):
-    await message.reply_text("Usage:\n/encode - start encoding flow\n/cancel - cancel current operation")
+    settings = f"Settings: {CODEC_LABEL} via {ENCODER}, CRF {CRF}"
+    if ENCODER == "libsvtav1":
+        settings += f", preset {AV1_PRESET}."
+    elif ENCODER == "libx265":
+        settings += f", preset {PRESET}" + (f", tune {TUNE}" if TUNE else "") + ".\n"
+        settings += ("Faster presets and zerolatency tuning encode much quicker but give slightly larger files "
+                     "at the same quality than slower presets like medium.")
+    else:
+        settings += "."
+    await message.reply_text(
+        "Usage:\n/encode - start encoding flow\n/preview - quick 720p encode (faster, smaller)\n/cancel - cancel current operation\n\n"
+        + settings
+    )
 
-# We'll use a simple approach: user sends /encode and then replies with a video/document
-user_waiting = set()
+# We'll use a simple approach: user sends /encode (or /preview) and then replies with a video/document.
+# Maps user id -> requested mode ("encode" or "preview"). Bounded with a TTL so entries left behind by
+# crashed handlers or users who never send a file expire instead of piling up.
+user_waiting = TTLCache(maxsize=10000, ttl=600)
 
 @client.on_message(filters.command("encode") & filters.private)
 async def encode_cmd(client: Client, message: Message):
     await message.reply_text("📥 Please send the video file you want to encode (reply to this message with the file).")
-    user_waiting.add(message.from_user.id)
+    user_waiting[message.from_user.id] = "encode"
+
+@client.on_message(filters.command("preview") & filters.private)
+async def preview_cmd(client: Client, message: Message):
+    await message.reply_text(f"📥 Please send the video file for a quick {PREVIEW_HEIGHT}p preview encode.")
+    user_waiting[message.from_user.id] = "preview"
 
 @client.on_message(filters.command("cancel") & filters.private)
 async def cancel_cmd(client: Client, message: Message):
-    user_waiting.discard(message.from_user.id)
+    user_waiting.pop(message.from_user.id, None)
     await message.reply_text("Cancelled. Use /encode to start again.")
 
 @client.on_message((filters.video | filters.document) & filters.private)
 async def handle_media(client: Client, message: Message):
     uid = message.from_user.id
-    if uid not in user_waiting:
+    mode = user_waiting.get(uid)
+    if mode is None:
         # Ignore unsolicited uploads
         return
+    preview = mode == "preview"
 
-    # Determine file object and filename
-    file = None
+    # Determine filename
     fname = None
     if message.video:
-        file = await message.video.get_file()
         fname = message.video.file_name or f"video_{uuid.uuid4().hex}.mp4"
     elif message.document:
         mime = message.document.mime_type or ""
         if "video" not in mime and not fname_looks_like_video(message.document.file_name or ""):
             await message.reply_text("❌ That doesn't look like a video file. Please send mp4/mkv video.")
-            user_waiting.discard(uid)
+            user_waiting.pop(uid, None)
             return
-        file = await message.document.get_file()
         fname = message.document.file_name or f"video_{uuid.uuid4().hex}.mkv"
 
+    # Same source + same settings as an earlier job: resend the earlier result by file_id,
+    # skipping download, encode and upload entirely
+    source_id = (message.video or message.document).file_unique_id
+    settings = f"{mode}:{ENCODER}:{CRF}:{PRESET}:{TUNE}:{AV1_PRESET}"
+    cached = cache_lookup(source_id, settings)
+    if cached:
+        sent_parts = 0
+        try:
+            for index, file_id in enumerate(cached):
+                if preview:
+                    caption = f"✅ Here is your {PREVIEW_HEIGHT}p preview."
+                else:
+                    caption = "✅ Here is your encoded video." if len(cached) == 1 else f"✅ Encoded video, part {index + 1}."
+                await message.reply_document(file_id, caption=caption, force_document=True)
+                sent_parts += 1
+            user_waiting.pop(uid, None)
+            return
+        except Exception:
+            # e.g. the file_id is no longer valid; drop the stale entry so the next attempt re-encodes
+            logger.exception("Sending cached encode failed")
+            cache_delete(source_id, settings)
+        if sent_parts:
+            # Re-encoding now would send the parts the user already has a second time
+            await message.reply_text(
+                f"❌ Only {sent_parts} of {len(cached)} previously encoded parts could be resent. "
+                "Use /encode and send the file again to re-encode it."
+            )
+            user_waiting.pop(uid, None)
+            return
+        await message.reply_text("♻️ The previously encoded copy is no longer available; re-encoding...")
+
     in_path = os.path.join(TMP_DIR, safe_filename(fname))
-    out_name = os.path.splitext(fname)[0] + "_encoded.mp4"
-    out_path = os.path.join(TMP_DIR, safe_filename(out_name))
+    out_name = os.path.splitext(fname)[0] + ("_preview.mp4" if preview else "_encoded.mp4")
+    thumb_path = os.path.join(TMP_DIR, f"{uuid.uuid4().hex}_thumb.jpg")
 
-    status = await message.reply_text("⬇️ Downloading your file... (this may take a while)")
+    status = DebouncedMsg(await message.reply_text("⬇️ Downloading your file... (this may take a while)"))
     try:
-        await file.download(in_path)
+        await client.download_media(message, file_name=in_path, progress=download_progress, progress_args=(status,))
+        # Pyrogram logs transfer errors instead of raising, leaving a missing or truncated file behind
+        expected = (message.video or message.document).file_size
+        got = os.path.getsize(in_path) if os.path.exists(in_path) else 0
+        if not got or (expected and got != expected):
+            raise IOError(f"incomplete download ({got} of {expected or '?'} bytes)")
     except Exception as e:
         logger.exception("Download failed")
-        await status.edit_text(f"❌ Failed to download file: {e}")
-        user_waiting.discard(uid)
+        await status.set(f"❌ Failed to download file: {e}", force=True)
+        user_waiting.pop(uid, None)
         if os.path.exists(in_path):
             os.remove(in_path)
         return
 
-    await status.edit_text("🔹 Encoding started... (this can be slow on Render if ffmpeg is CPU-limited)")
+    # Inputs whose encode won't fit one upload are encoded in parts, sized from a sample-based estimate
+    # of the output bitrate. Smaller inputs can't produce a bigger encode in practice, so skip the estimate.
+    segment_time = 0.0
+    if not preview and os.path.getsize(in_path) > SEGMENT_BUDGET:
+        duration = await probe_duration(in_path)
+        if duration:
+            await status.set("🔎 Estimating encoded size...", force=True)
+            estimate = await estimate_output_size(in_path, duration, CRF, PRESET, TUNE)
+            if estimate > SEGMENT_BUDGET:
+                segment_time = max(SEGMENT_MIN_TIME, duration * SEGMENT_BUDGET / estimate)
+    if segment_time:
+        file_ids = await encode_in_parts(message, status, in_path, out_name, thumb_path, segment_time)
+        if file_ids:
+            try:
+                cache_store(source_id, settings, file_ids)
+            except Exception:
+                logger.exception("Caching encoded parts failed")
+        for p in (in_path, thumb_path):
+            try:
+                if os.path.exists(p):
+                    os.remove(p)
+            except Exception:
+                logger.exception("Cleanup error for %s", p)
+        user_waiting.pop(uid, None)
+        return
+
+    await status.set("🔹 Encoding started... (this can be slow on Render if ffmpeg is CPU-limited)", force=True)
+    out_file = NamedSpool(out_name)
     try:
-        retcode, stderr = await run_ffmpeg(in_path, out_path, config.CRF, config.PRESET)
+        if preview:
+            retcode, stderr = await run_ffmpeg(in_path, out_file, CRF, "ultrafast", TUNE, height=PREVIEW_HEIGHT)
+        else:
+            retcode, stderr = await run_ffmpeg(in_path, out_file, CRF, PRESET, TUNE)
         if retcode != 0:
             logger.error("FFmpeg error: %s", stderr[:2000])
-            await status.edit_text("❌ Encoding failed. FFmpeg returned an error.")
+            await status.set("❌ Encoding failed. FFmpeg returned an error.", force=True)
             await message.reply_text(f"FFmpeg error (short):\n{stderr[:1000] or 'No details'}")
+            out_file.close()
             if os.path.exists(in_path):
                 os.remove(in_path)
-            user_waiting.discard(uid)
+            user_waiting.pop(uid, None)
             return
     except asyncio.TimeoutError:
-        await status.edit_text("❌ Encoding timed out.")
+        await status.set("❌ Encoding timed out.", force=True)
+        out_file.close()
         if os.path.exists(in_path):
             os.remove(in_path)
-        user_waiting.discard(uid)
+        user_waiting.pop(uid, None)
         return
     except Exception as e:
         logger.exception("Unexpected error")
-        await status.edit_text(f"❌ Unexpected error: {e}")
+        await status.set(f"❌ Unexpected error: {e}", force=True)
+        out_file.close()
         if os.path.exists(in_path):
             os.remove(in_path)
-        user_waiting.discard(uid)
+        user_waiting.pop(uid, None)
         return
 
-    if not os.path.exists(out_path):
-        await status.edit_text("❌ Encoding finished but output file not found.")
+    size_mb = out_file.tell() / (1024*1024)
+    if not size_mb:
+        await status.set("❌ Encoding finished but produced no output.", force=True)
+        out_file.close()
         if os.path.exists(in_path):
             os.remove(in_path)
-        user_waiting.discard(uid)
+        user_waiting.pop(uid, None)
         return
 
-    size_mb = os.path.getsize(out_path) / (1024*1024)
     if size_mb > 49.5:
-        await status.edit_text(f"⚠️ Encoding finished but file is {size_mb:.1f} MB. Bots may not be able to upload >50MB. Sending attempt anyway...")
+        await status.set(f"⚠️ Encoding finished but file is {size_mb:.1f} MB. Bots may not be able to upload >50MB. Sending attempt anyway...", force=True)
     else:
-        await status.edit_text("⚙️ Uploading encoded file...")
+        await status.set("⚙️ Uploading encoded file...")
 
+    sent = None
     try:
-        await message.reply_document(out_path, caption="✅ Here is your encoded video.")
-        await status.edit_text("✅ Done! Encoded file sent. Cleaning up...")
+        thumb = thumb_path if await make_thumbnail(in_path, thumb_path) else None
+        caption = f"✅ Here is your {PREVIEW_HEIGHT}p preview." if preview else "✅ Here is your encoded video."
+        out_file.seek(0)
+        sent = await message.reply_document(out_file, file_name=out_name, thumb=thumb, caption=caption, force_document=True)
+        await status.set("✅ Done! Encoded file sent. Cleaning up...", force=True)
     except Exception as e:
         logger.exception("Upload failed")
-        await status.edit_text(f"❌ Failed to upload encoded file: {e}")
+        await status.set(f"❌ Failed to upload encoded file: {e}", force=True)
     finally:
-        for p in (in_path, out_path):
+        out_file.close()
+        for p in (in_path, thumb_path):
             try:
                 if os.path.exists(p):
                     os.remove(p)
             except Exception:
                 logger.exception("Cleanup error for %s", p)
 
-    user_waiting.discard(uid)
+    file_id = sent_file_id(sent)
+    if file_id:
+        try:
+            cache_store(source_id, settings, [file_id])
+        except Exception:
+            logger.exception("Caching encoded file failed")
+
+    user_waiting.pop(uid, None)
 
 if __name__ == "__main__":
+    logger.info("Using video encoder: %s", ENCODER)
+    if ENCODER == "libx265":
+        config.check_x265_asm()
+    # Pyrogram silently falls back to pure-Python AES (pyaes) without TgCrypto, making transfers far slower
+    try:
+        import tgcrypto  # noqa: F401
+        logger.info("MTProto crypto backend: TgCrypto")
+    except ImportError:
+        logger.warning("MTProto crypto backend: pure Python (TgCrypto not installed) - uploads/downloads will be slow. pip install tgcrypto")
+    # Keep a reference so the task isn't garbage collected; it runs once client.run() starts the loop
+    gc_task = client.loop.create_task(gc_tmp())
     # Run the client
     client.run()